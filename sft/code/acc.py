@@ -25,7 +25,7 @@ def save_checkpoint(model, accelerator, config):
 @hydra.main(config_path="../config", config_name="train")
 def main(config: DictConfig):
     print(config)
-    seed_everything(config["seed"])
+    seed_everything(config["seed"], config.get("deterministic", False))
     accelerator = Accelerator(
         log_with="wandb",
         gradient_accumulation_steps=config["gradient_accumulation_steps"],
@@ -41,18 +41,31 @@ def main(config: DictConfig):
     if accelerator.is_main_process:
         print(f"Using {config['model_name']} for training")
 
-    model, tokenizer = load_model_and_tokenizer(config["model_name"])
+    # packed batches carry no attention_mask, only flash_attention_2 keeps attention
+    # within each packed sequence
+    packing = config.get("packing", False)
+    model, tokenizer = load_model_and_tokenizer(
+        config["model_name"],
+        attn_implementation="flash_attention_2" if packing else None,
+    )
+    if packing and model.config._attn_implementation != "flash_attention_2":
+        raise ValueError(
+            "packing requires attn_implementation='flash_attention_2', got "
+            f"{model.config._attn_implementation!r}"
+        )
     if config["gradient_checkpointing"]:
         model.gradient_checkpointing_enable()
 
     # dataset
-    if config["test"]:
-        #  Use a smaller subset of data for testing
-        test_config = config.copy()
-        test_config["max_samples"] = 100  # Limit to 100 samples for testing
-        train_dataloader = get_dataloader(test_config, tokenizer)
-    else:
-        train_dataloader = get_dataloader(config, tokenizer)
+    # let the main process build the tokenized cache, other ranks then load it
+    with accelerator.main_process_first():
+        if config["test"]:
+            #  Use a smaller subset of data for testing
+            test_config = config.copy()
+            test_config["max_samples"] = 100  # Limit to 100 samples for testing
+            train_dataloader = get_dataloader(test_config, tokenizer)
+        else:
+            train_dataloader = get_dataloader(config, tokenizer)
 
     # optimizer
     no_decay = ["bias", "LayerNorm.weight"]
@@ -1,8 +1,14 @@
+import hashlib
+import json
+import os
+import shutil
 from functools import partial
 
-from datasets import load_dataset
-from torch.utils.data import DataLoader, Dataset, Subset
-from transformers import DataCollatorForSeq2Seq
+import numpy as np
+import pyarrow.compute as pc
+import torch
+from datasets import load_dataset, load_from_disk
+from torch.utils.data import DataLoader, Dataset, Sampler, Subset
 
 prompt_template = """
 {question}
@@ -27,63 +33,195 @@ alpaca_eval_response_template = """
 """
 
 
-def preprocess_chat_dataset(messages, tokenizer, config, INGORE_INDEX=-100):
-    messages = messages["conversation"]
-    inputs = tokenizer.apply_chat_template(messages, add_generation_prompt=True)
-    data = {}
-    data["input_ids"] = inputs
-    data["labels"] = inputs.copy()
-    data["attention_mask"] = [1] * len(inputs)
-
-    for idx, message in enumerate(messages):
-        if message["role"] != "assistant":
-            if idx == 0:
-                message_start_idx = 0
-            else:
-                message_start_idx = len(tokenizer.apply_chat_template(messages[:idx]))
-
-            if idx < len(messages) - 1 and messages[idx + 1]["role"] == "assistant":
-                # if next role is "assistant", include the generation prompt to be ignored
-                message_end_idx = len(
-                    tokenizer.apply_chat_template(
-                        messages[: idx + 1], add_generation_prompt=True
-                    )
-                )
-            else:
-                message_end_idx = len(
-                    tokenizer.apply_chat_template(messages[: idx + 1])
-                )
-            # set this message to be ignored
-            data["labels"][message_start_idx:message_end_idx] = [INGORE_INDEX] * (
-                message_end_idx - message_start_idx
-            )
-    if "max_length" in config:
-        data["input_ids"] = data["input_ids"][: config["max_length"]]
-        data["labels"] = data["labels"][: config["max_length"]]
-        data["attention_mask"] = data["attention_mask"][: config["max_length"]]
+def _assistant_affixes(tokenizer):
+    """Text the chat template emits around an assistant reply, e.g.
+    `(<|im_start|>assistant\n, <|im_end|>\n)`."""
+    probe = "<assistant probe>"
+    prompt = [{"role": "user", "content": "hi"}]
+    prompt_text, text = tokenizer.apply_chat_template(
+        [prompt, prompt + [{"role": "assistant", "content": probe}]], tokenize=False
+    )
+    generation_prompt = tokenizer.apply_chat_template(
+        prompt, tokenize=False, add_generation_prompt=True
+    )
+    prefix = generation_prompt[len(prompt_text) :]
+    suffix = text[text.index(probe) + len(probe) :]
+    return prefix, suffix
+
+
+def _assistant_char_spans(text, messages, affixes):
+    """Char spans `(start, end)` of every assistant reply (plus its suffix) in `text`."""
+    prefix, suffix = affixes
+    spans = []
+    cursor = 0
+    for message in messages:
+        if message["role"] == "assistant":
+            # skip the assistant header first, short replies may occur inside it
+            prefix_start = text.find(prefix, cursor)
+            if prefix_start != -1:
+                cursor = prefix_start + len(prefix)
+        content = message["content"].strip()
+        content_start = text.find(content, cursor)
+        if content_start == -1:
+            # the template rewrote this message, nothing to anchor on
+            continue
+        cursor = content_start + len(content)
+        if message["role"] == "assistant":
+            # templates may keep whitespace the stripped content doesn't have
+            suffix_start = text.find(suffix, cursor)
+            if suffix_start != -1 and not text[cursor:suffix_start].strip():
+                cursor = suffix_start + len(suffix)
+            spans.append((content_start, cursor))
+    return spans
+
+
+def render_chat_dataset(examples, tokenizer):
+    # render every conversation once and record where its assistant replies are,
+    # so tokenization needs no further template evaluation
+    conversations = examples["conversation"]
+    texts = tokenizer.apply_chat_template(conversations, tokenize=False)
+    affixes = _assistant_affixes(tokenizer)
+    return {
+        "text": texts,
+        "assistant_spans": [
+            _assistant_char_spans(text, messages, affixes)
+            for messages, text in zip(conversations, texts)
+        ],
+    }
+
+
+def tokenize_chat_dataset(examples, tokenizer, config, INGORE_INDEX=-100):
+    # tokenize the whole batch of rendered texts in a single call and project the
+    # assistant replies onto tokens through the offsets
+    encodings = tokenizer(
+        examples["text"], add_special_tokens=False, return_offsets_mapping=True
+    )
+
+    data = {"input_ids": [], "labels": [], "attention_mask": []}
+    for char_spans, inputs, offsets in zip(
+        examples["assistant_spans"], encodings["input_ids"], encodings["offset_mapping"]
+    ):
+        # store narrow dtypes, collators widen them to int64 only when building batches
+        token_starts = np.asarray([start for start, _ in offsets])
+        inputs = np.asarray(inputs, dtype=np.int32)
+        labels = inputs.copy()
+        attention_mask = np.ones(len(inputs), dtype=np.uint8)
+
+        # only assistant replies contribute to the loss: project all their char spans
+        # onto token indices at once and mask everything outside of them
+        spans = np.searchsorted(token_starts, np.reshape(char_spans, (-1, 2)))
+        coverage = np.zeros(len(inputs) + 1, dtype=np.int32)
+        np.add.at(coverage, spans[:, 0], 1)
+        np.add.at(coverage, spans[:, 1], -1)
+        labels[np.cumsum(coverage[:-1]) == 0] = INGORE_INDEX
+
+        if "max_length" in config:
+            inputs = inputs[: config["max_length"]]
+            labels = labels[: config["max_length"]]
+            attention_mask = attention_mask[: config["max_length"]]
+        data["input_ids"].append(inputs)
+        data["labels"].append(labels)
+        data["attention_mask"].append(attention_mask)
     return data
 
 
-def apply_input_output_template(example):
-    convs = []
-    prompt = prompt_template.format(question=example["Question"])
-    convs.append({"role": "user", "content": prompt})
-    res = response_template.format(
-        cot=example["Complex_CoT"], response=example["Response"]
+def preprocess_chat_dataset(examples, tokenizer, config, INGORE_INDEX=-100):
+    return tokenize_chat_dataset(
+        render_chat_dataset(examples, tokenizer), tokenizer, config, INGORE_INDEX
+    )
+
+
+def apply_input_output_template(examples, tokenizer):
+    conversations = []
+    for question, cot, response in zip(
+        examples["Question"], examples["Complex_CoT"], examples["Response"]
+    ):
+        convs = []
+        prompt = prompt_template.format(question=question)
+        convs.append({"role": "user", "content": prompt})
+        res = response_template.format(cot=cot, response=response)
+        convs.append({"role": "assistant", "content": res})
+        conversations.append(convs)
+    return render_chat_dataset({"conversation": conversations}, tokenizer)
+
+
+def _conversation_hashes(conversations):
+    # a fixed-width digest per conversation: the first 8 bytes of its sha256 as a
+    # uint64, collisions among ~1M conversations are vanishingly unlikely
+    hashes = np.empty(len(conversations), dtype=np.uint64)
+    for i, conversation in enumerate(conversations):
+        conversation = json.dumps(conversation, sort_keys=True).encode("utf-8")
+        hashes[i] = int.from_bytes(hashlib.sha256(conversation).digest()[:8], "little")
+    return {"hash": hashes}
+
+
+def deduplicate_conversations(dataset, num_proc):
+    # hash into a separate, hash-only dataset so the conversations aren't rewritten,
+    # then keep only the first occurrence of each hash in the original dataset
+    hashes = dataset.map(
+        _conversation_hashes,
+        input_columns=["conversation"],
+        remove_columns=dataset.column_names,
+        batched=True,
+        num_proc=num_proc,
+    )
+    _, first_indices = np.unique(
+        hashes.data.column("hash").to_numpy(), return_index=True
+    )
+    return dataset.select(np.sort(first_indices))
+
+
+# bump whenever the preprocessing code changes the tokenized rows
+PREPROCESS_VERSION = 1
+
+
+def _cache_fingerprint(config, tokenizer):
+    # everything that changes the tokenized rows, so a stale cache is never reused
+    settings = {
+        "version": PREPROCESS_VERSION,
+        "tokenizer": tokenizer.name_or_path,
+        "chat_template": tokenizer.chat_template,
+        "max_length": config.get("max_length"),
+        "dedup": config.get("dedup", False),
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+def tokenize_and_cache(config, tokenizer):
+    # tokenize once and keep the result on disk, later runs (and every DDP rank)
+    # memory-map the Arrow files instead of re-tokenizing the whole corpus
+    cache_path = config.get("tokenized_cache_path")
+    if cache_path is not None:
+        cache_path = os.path.join(
+            cache_path, _cache_fingerprint(config, tokenizer)[:16]
+        )
+    if cache_path is not None and os.path.exists(cache_path):
+        return load_from_disk(cache_path, keep_in_memory=False)
+
+    dataset = load_dataset("lmsys/lmsys-chat-1m", split="train")
+    if config.get("dedup", False):
+        dataset = deduplicate_conversations(dataset, config["num_proc"])
+    dataset = dataset.map(
+        partial(preprocess_chat_dataset, tokenizer=tokenizer, config=config),
+        num_proc=config["num_proc"],
+        batched=True,
+        batch_size=1000,
+        remove_columns=dataset.column_names,
     )
-    convs.append({"role": "assistant", "content": res})
-    return {"conversation": convs}
+    if cache_path is not None:
+        # build next to the final path and swap it in once complete, so a crashed
+        # or interrupted save never looks like a valid cache
+        tmp_path = cache_path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        dataset.save_to_disk(tmp_path, num_proc=config["num_proc"])
+        os.replace(tmp_path, cache_path)
+        dataset = load_from_disk(cache_path, keep_in_memory=False)
+    return dataset
 
 
 class LMSYS_CHAT_1M_Dataset(Dataset):
     def __init__(self, config, tokenizer):
-        self.dataset = load_dataset("lmsys/lmsys-chat-1m", split="train")
-        self.dataset = self.dataset.map(
-            lambda x: preprocess_chat_dataset(x, tokenizer, config),
-            num_proc=config["num_proc"],
-            batched=True,
-            remove_columns=self.dataset.column_names,
-        )
+        self.dataset = tokenize_and_cache(config, tokenizer)
 
     def __len__(self):
         return len(self.dataset)
@@ -96,20 +234,26 @@ class SFTDataset(Dataset):
     def __init__(self, config, tokenizer):
         self.dataset = load_dataset(config["data_path"], split="train")
 
-        # map input output template
+        # map input output template, rendered through the chat template
         self.dataset = self.dataset.map(
-            apply_input_output_template, num_proc=config["num_proc"]
+            partial(apply_input_output_template, tokenizer=tokenizer),
+            num_proc=config["num_proc"],
+            batched=True,
+            batch_size=1000,
+            remove_columns=self.dataset.column_names,
         )
 
         # map tokenize
         map_func = partial(
-            preprocess_chat_dataset,
+            tokenize_chat_dataset,
             tokenizer=tokenizer,
             config=config,
         )
         self.dataset = self.dataset.map(
             map_func,
             num_proc=config["num_proc"],
+            batched=True,
+            batch_size=1000,
             remove_columns=self.dataset.column_names,
         )
 
@@ -184,6 +328,127 @@ class AlpacaEvalDataset(Dataset):
         return self.dataset[index]
 
 
+def pack_sequences(examples, max_length, INGORE_INDEX=-100):
+    # first-fit decreasing: place the longest sequences first, each into the first
+    # bin that still has room, so every packed row is close to `max_length`
+    lengths = [len(input_ids) for input_ids in examples["input_ids"]]
+    bins, bin_lengths = [], []
+    for idx in sorted(range(len(lengths)), key=lengths.__getitem__, reverse=True):
+        for bin_idx, bin_length in enumerate(bin_lengths):
+            if bin_length + lengths[idx] <= max_length:
+                bins[bin_idx].append(idx)
+                bin_lengths[bin_idx] += lengths[idx]
+                break
+        else:
+            bins.append([idx])
+            bin_lengths.append(lengths[idx])
+
+    packed = {"input_ids": [], "labels": [], "position_ids": []}
+    for indices in bins:
+        input_ids, labels, position_ids = [], [], []
+        for idx in indices:
+            input_ids += examples["input_ids"][idx]
+            # the first token of a sequence must not be predicted from the previous one
+            labels += [INGORE_INDEX] + examples["labels"][idx][1:]
+            # positions restart at every sequence, marking the document boundaries
+            position_ids += list(range(lengths[idx]))
+        packed["input_ids"].append(np.asarray(input_ids, dtype=np.int32))
+        packed["labels"].append(np.asarray(labels, dtype=np.int32))
+        packed["position_ids"].append(np.asarray(position_ids, dtype=np.int32))
+    return packed
+
+
+def collate_packed(batch):
+    # flatten the packed rows into one padding-free row and leave out attention_mask:
+    # flash_attention_2 then derives `cu_seqlens` from the restarting position_ids
+    # and attends within each sequence only, any other attention implementation
+    # would attend across sequences (acc.py refuses to pack without it)
+    data = {"input_ids": [], "labels": [], "position_ids": []}
+    for item in batch:
+        for key in data:
+            data[key] += item[key]
+    return {key: torch.tensor([value], dtype=torch.long) for key, value in data.items()}
+
+
+class FastCollator:
+    # pad the whole batch with one preallocated array per field and convert it to
+    # tensors once, instead of padding example by example
+    def __init__(self, pad_token_id, INGORE_INDEX=-100):
+        self.pad_token_id = pad_token_id
+        self.ignore_index = INGORE_INDEX
+
+    def __call__(self, batch):
+        lengths = [len(item["input_ids"]) for item in batch]
+        input_ids = np.full(
+            (len(batch), max(lengths)), self.pad_token_id, dtype=np.int32
+        )
+        labels = np.full_like(input_ids, self.ignore_index)
+        attention_mask = np.zeros_like(input_ids, dtype=np.uint8)
+        for i, (item, length) in enumerate(zip(batch, lengths)):
+            input_ids[i, :length] = item["input_ids"]
+            labels[i, :length] = item["labels"]
+            attention_mask[i, :length] = 1
+        return {
+            "input_ids": torch.from_numpy(input_ids).long(),
+            "labels": torch.from_numpy(labels).long(),
+            "attention_mask": torch.from_numpy(attention_mask).long(),
+        }
+
+
+class BucketSampler(Sampler):
+    # yields batches drawn from a single length bucket, so sequences in a batch have
+    # similar lengths and little padding; buckets are length quantiles and the
+    # batches of all buckets are shuffled together every epoch
+    def __init__(
+        self, lengths, batch_size, num_buckets=16, shuffle=True, drop_last=False, seed=0
+    ):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.num_buckets = num_buckets
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _buckets(self):
+        order = np.argsort(self.lengths, kind="stable")
+        return np.array_split(order, self.num_buckets)
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+
+        batches, tails = [], []
+        for bucket in self._buckets():
+            if self.shuffle:
+                bucket = rng.permutation(bucket)
+            num_full = len(bucket) // self.batch_size * self.batch_size
+            batches += list(bucket[:num_full].reshape(-1, self.batch_size))
+            tails.append(bucket[num_full:])
+        if self.shuffle:
+            rng.shuffle(batches)
+
+        # the bucket tails are merged (they stay roughly length-sorted) and appended
+        # after the shuffled full batches, so only the very last batch can be short,
+        # as accelerate's `BatchSamplerShard` expects
+        tail = np.concatenate(tails)
+        for start in range(0, len(tail), self.batch_size):
+            batch = tail[start : start + self.batch_size]
+            if self.drop_last and len(batch) < self.batch_size:
+                continue
+            batches.append(batch)
+        return iter([batch.tolist() for batch in batches])
+
+    def __len__(self):
+        num_samples = len(self.lengths)
+        if self.drop_last:
+            return num_samples // self.batch_size
+        return -(-num_samples // self.batch_size)
+
+
 def get_dataloader(config, tokenizer):
     if config["dataset"] == "lmsys/lmsys-chat-1m":
         ds = LMSYS_CHAT_1M_Dataset(config, tokenizer)
@@ -192,16 +457,59 @@ def get_dataloader(config, tokenizer):
     else:
         ds = SFTDataset(config, tokenizer)
 
+    if config.get("packing", False):
+        # pack tokenized sequences back to back into `max_length` rows
+        ds.dataset = ds.dataset.map(
+            partial(pack_sequences, max_length=config["max_length"]),
+            num_proc=config["num_proc"],
+            batched=True,
+            batch_size=1000,
+            remove_columns=ds.dataset.column_names,
+        )
+        data_collator = collate_packed
+    else:
+        data_collator = FastCollator(tokenizer.pad_token_id)
+
+    group_by_length = config.get("group_by_length", False)
+    if group_by_length:
+        # read the lengths straight from the Arrow offsets, no rows are decoded
+        lengths = pc.list_value_length(ds.dataset.data.column("input_ids")).to_numpy()
+
     if hasattr(config, "max_samples") and config.max_samples is not None:
         ds = Subset(ds, range(config.max_samples))
+        if group_by_length:
+            lengths = lengths[: config.max_samples]
+
+    # tokenization already ran in `.map(num_proc=...)`, loader workers only fetch
+    # Arrow rows and collate, so they are sized independently
+    num_workers = config.get("num_loader_workers")
+    if num_workers is None:
+        num_workers = min(8, os.cpu_count())
+    if group_by_length:
+        batching = {
+            "batch_sampler": BucketSampler(
+                lengths,
+                batch_size=config["per_device_train_batch_size"],
+                num_buckets=config.get("num_length_buckets", 16),
+                shuffle=config["shuffle"],
+                drop_last=config["drop_last"],
+                seed=config.get("seed", 0),
+            )
+        }
+    else:
+        batching = {
+            "batch_size": config["per_device_train_batch_size"],
+            "shuffle": config["shuffle"],
+            "drop_last": config["drop_last"],
+        }
     dataloader = DataLoader(
         dataset=ds,
-        batch_size=config["per_device_train_batch_size"],
-        shuffle=config["shuffle"],
-        num_workers=config["num_proc"],
-        drop_last=config["drop_last"],
+        **batching,
+        num_workers=num_workers,
         pin_memory=True,
         collate_fn=data_collator,
+        persistent_workers=num_workers > 0,
+        prefetch_factor=4 if num_workers > 0 else None,
     )
 
     return dataloader
@@ -5,10 +5,12 @@ import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
 
-def load_model_and_tokenizer(config):
+def load_model_and_tokenizer(config, attn_implementation=None):
     tokenizer = AutoTokenizer.from_pretrained(config["model_name_or_path"])
     model = AutoModelForCausalLM.from_pretrained(
-        config["model_name_or_path"], torch_dtype="bfloat16"
+        config["model_name_or_path"],
+        torch_dtype="bfloat16",
+        attn_implementation=attn_implementation,
     )
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
@@ -16,10 +18,17 @@ def load_model_and_tokenizer(config):
     return model, tokenizer
 
 
-def seed_everything(seed: int):
+def seed_everything(seed: int, deterministic: bool = False):
     random.seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    if deterministic:
+        # reproducible runs for debugging, at the cost of slower kernels
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cudnn.benchmark = False
+    else:
+        # let cudnn pick the fastest algorithms and run fp32 matmuls on TF32 cores
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.set_float32_matmul_precision("high")
@@ -0,0 +1,226 @@
+import re
+import sys
+from pathlib import Path
+
+import pytest
+from jinja2.sandbox import ImmutableSandboxedEnvironment
+
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+from sft.code.prepare_data import (
+    BucketSampler,
+    collate_packed,
+    pack_sequences,
+    preprocess_chat_dataset,
+)
+
+QWEN_CHAT_TEMPLATE = (
+    "{%- if messages[0]['role'] == 'system' %}"
+    "{{- '<|im_start|>system\\n' + messages[0]['content'] + '<|im_end|>\\n' }}"
+    "{%- else %}"
+    "{{- '<|im_start|>system\\nYou are a helpful assistant.<|im_end|>\\n' }}"
+    "{%- endif %}"
+    "{%- for message in messages %}"
+    "{%- if not (message['role'] == 'system' and loop.first) %}"
+    "{{- '<|im_start|>' + message['role'] + '\\n' + message['content'] + '<|im_end|>\\n' }}"
+    "{%- endif %}"
+    "{%- endfor %}"
+    "{%- if add_generation_prompt %}{{- '<|im_start|>assistant\\n' }}{%- endif %}"
+)
+
+
+class CharTokenizer:
+    # stands in for a fast tokenizer: special tokens are single tokens, every other
+    # character is its own token, and offsets map tokens back to characters
+    name_or_path = "char-tokenizer"
+    chat_template = QWEN_CHAT_TEMPLATE
+    special_tokens_map = {"eos_token": "<|im_end|>"}
+    special_tokens = ["<|im_start|>", "<|im_end|>"]
+
+    def __init__(self):
+        self.pattern = re.compile(
+            "|".join(map(re.escape, self.special_tokens)) + "|.", re.DOTALL
+        )
+        self.vocab = {}
+        self.template = ImmutableSandboxedEnvironment(
+            trim_blocks=True, lstrip_blocks=True
+        ).from_string(self.chat_template)
+
+    def apply_chat_template(
+        self, conversation, tokenize=False, add_generation_prompt=False
+    ):
+        # like transformers, a list of conversations renders to a list of texts
+        if isinstance(conversation[0], dict):
+            return self.template.render(
+                messages=conversation, add_generation_prompt=add_generation_prompt
+            )
+        return [
+            self.apply_chat_template(messages, tokenize, add_generation_prompt)
+            for messages in conversation
+        ]
+
+    def _encode(self, text):
+        input_ids, offsets = [], []
+        for match in self.pattern.finditer(text):
+            input_ids.append(self.vocab.setdefault(match.group(), len(self.vocab)))
+            offsets.append(match.span())
+        return input_ids, offsets
+
+    def __call__(self, texts, add_special_tokens=False, return_offsets_mapping=False):
+        encodings = [self._encode(text) for text in texts]
+        return {
+            "input_ids": [input_ids for input_ids, _ in encodings],
+            "offset_mapping": [offsets for _, offsets in encodings],
+        }
+
+    def decode(self, input_ids):
+        itos = {i: s for s, i in self.vocab.items()}
+        return "".join(itos[i] for i in input_ids)
+
+
+def supervised_spans(tokenizer, data):
+    # decode every maximal run of tokens that is not masked out
+    spans, run = [], []
+    for input_id, label in zip(data["input_ids"][0], data["labels"][0]):
+        if label == -100:
+            if run:
+                spans.append(tokenizer.decode(run))
+            run = []
+        else:
+            assert label == input_id
+            run.append(input_id)
+    if run:
+        spans.append(tokenizer.decode(run))
+    return spans
+
+
+def test_only_assistant_replies_are_supervised():
+    tokenizer = CharTokenizer()
+    conversation = [
+        {"role": "user", "content": "What is 1 + 1?"},
+        {"role": "assistant", "content": "It is 2. "},
+        {"role": "user", "content": "And the first letter of the alphabet?"},
+        # short enough to also occur inside the `assistant` role header
+        {"role": "assistant", "content": "a"},
+    ]
+    data = preprocess_chat_dataset({"conversation": [conversation]}, tokenizer, {})
+
+    assert supervised_spans(tokenizer, data) == [
+        "It is 2. <|im_end|>\n",
+        "a<|im_end|>\n",
+    ]
+
+
+@pytest.mark.parametrize(
+    "conversation",
+    [
+        [{"role": "user", "content": "Hello"}],
+        [
+            {"role": "system", "content": "Be brief."},
+            {"role": "user", "content": "Hello"},
+        ],
+    ],
+)
+def test_conversation_without_replies_is_fully_masked(conversation):
+    tokenizer = CharTokenizer()
+    data = preprocess_chat_dataset({"conversation": [conversation]}, tokenizer, {})
+
+    assert len(data["labels"][0]) > 0
+    assert all(label == -100 for label in data["labels"][0])
+
+
+def make_sampler(drop_last, seed=0):
+    # 103 samples of mixed lengths, not a multiple of the batch size or bucket count
+    lengths = [(i * 37) % 101 + 1 for i in range(103)]
+    return BucketSampler(
+        lengths, batch_size=8, num_buckets=4, drop_last=drop_last, seed=seed
+    )
+
+
+@pytest.mark.parametrize("drop_last", [False, True])
+def test_bucket_sampler_yields_every_index_once(drop_last):
+    batches = list(make_sampler(drop_last))
+    indices = [index for batch in batches for index in batch]
+
+    assert len(indices) == len(set(indices))
+    if drop_last:
+        assert len(indices) == 103 // 8 * 8
+    else:
+        assert sorted(indices) == list(range(103))
+
+
+@pytest.mark.parametrize("drop_last", [False, True])
+def test_bucket_sampler_only_last_batch_is_short(drop_last):
+    batches = list(make_sampler(drop_last))
+
+    assert all(len(batch) == 8 for batch in batches[:-1])
+    assert len(batches[-1]) == (8 if drop_last else 103 % 8)
+
+
+@pytest.mark.parametrize("drop_last", [False, True])
+def test_bucket_sampler_len_matches_iteration(drop_last):
+    sampler = make_sampler(drop_last)
+
+    assert len(sampler) == len(list(sampler))
+
+
+@pytest.mark.parametrize("drop_last", [False, True])
+def test_bucket_sampler_is_deterministic_per_seed_and_epoch(drop_last):
+    first, second = make_sampler(drop_last, seed=3), make_sampler(drop_last, seed=3)
+    first.set_epoch(5)
+    second.set_epoch(5)
+
+    assert list(first) == list(second)
+
+
+def make_sequences(lengths):
+    # sequence i is filled with token i, labels are the tokens themselves
+    input_ids = [[i] * length for i, length in enumerate(lengths)]
+    return {"input_ids": input_ids, "labels": [list(ids) for ids in input_ids]}
+
+
+def split_packed(row):
+    # cut a packed row at every position_ids restart
+    starts = [i for i, position in enumerate(row["position_ids"]) if position == 0]
+    return [
+        {key: list(row[key][start:end]) for key in row}
+        for start, end in zip(starts, starts[1:] + [len(row["position_ids"])])
+    ]
+
+
+def test_pack_sequences_respects_max_length():
+    lengths = [7, 3, 5, 2, 8, 1, 4, 6]
+    packed = pack_sequences(make_sequences(lengths), max_length=10)
+
+    assert all(len(input_ids) <= 10 for input_ids in packed["input_ids"])
+    assert sum(len(ids) for ids in packed["input_ids"]) == sum(lengths)
+
+
+def test_pack_sequences_marks_sequence_boundaries():
+    packed = pack_sequences(make_sequences([7, 3, 5, 2, 8, 1, 4, 6]), max_length=10)
+
+    num_sequences = 0
+    for row in zip(packed["input_ids"], packed["labels"], packed["position_ids"]):
+        for sequence in split_packed(dict(zip(packed, row))):
+            num_sequences += 1
+            token = sequence["input_ids"][0]
+            # one whole sequence per restart, with positions counting from zero
+            assert sequence["input_ids"] == [token] * len(sequence["input_ids"])
+            assert sequence["position_ids"] == list(range(len(sequence["input_ids"])))
+            # the first token is never predicted from the previous sequence
+            assert sequence["labels"] == [-100] + sequence["input_ids"][1:]
+    assert num_sequences == 8
+
+
+def test_collate_packed_returns_one_row_without_attention_mask():
+    packed = pack_sequences(make_sequences([7, 3, 5, 2]), max_length=10)
+    batch = [
+        {key: packed[key][i].tolist() for key in packed}
+        for i in range(len(packed["input_ids"]))
+    ]
+    collated = collate_packed(batch)
+
+    assert set(collated) == {"input_ids", "labels", "position_ids"}
+    assert all(value.shape == (1, 17) for value in collated.values())
+    assert collated["position_ids"].tolist()[0] == sum(
+        (item["position_ids"] for item in batch), []
+    )
@@ -24,7 +24,8 @@ def get_train_objs(gpt_cfg: CfgNode, opt_cfg: OptimizerConfig, data_cfg: DataCon
 
     gpt_cfg.vocab_size = dataset.vocab_size
     gpt_cfg.block_size = dataset.block_size
-    model = GPT(gpt_cfg)
+    # move to the GPU before building the optimizer, fused AdamW requires it
+    model = GPT(gpt_cfg).to(torch.cuda.current_device())
     optimizer = create_optimizer(model, opt_cfg)
 
     return model, optimizer, train_set, test_set
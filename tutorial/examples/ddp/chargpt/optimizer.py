@@ -7,6 +7,7 @@ import torch
 class OptimizerConfig:
     weight_decay: float = None
     learning_rate: float = None
+    fused: bool = True
 
 
 def create_optimizer(model: torch.nn.Module, opt_config: OptimizerConfig):
@@ -69,7 +70,11 @@ def create_optimizer(model: torch.nn.Module, opt_config: OptimizerConfig):
             "weight_decay": 0.0,
         },
     ]
+    # the fused kernel updates all parameters in one launch, it needs them on the GPU
     optimizer = torch.optim.AdamW(
-        optim_groups, lr=opt_config.learning_rate, betas=(0.9, 0.95)
+        optim_groups,
+        lr=opt_config.learning_rate,
+        betas=(0.9, 0.95),
+        fused=opt_config.fused,
     )
     return optimizer
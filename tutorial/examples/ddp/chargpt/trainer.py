@@ -1,5 +1,6 @@
 import os
-from dataclasses import asdict, dataclass
+import threading
+from dataclasses import dataclass
 from typing import Any, Dict, Optional, OrderedDict
 
 import fsspec
@@ -20,6 +21,7 @@ class TrainerConfig:
     snapshot_path: Optional[str] = None
     save_every: int = None
     use_amp: bool = None
+    use_compile: bool = False
 
 
 @dataclass
@@ -29,6 +31,44 @@ class Snapshot:
     finished_epoch: int
 
 
+class CudaPrefetcher:
+    """
+    Copies the next batch to the GPU on a side stream while the current batch is
+    being computed. Adapted from the `data_prefetcher` of NVIDIA apex's ImageNet
+    example.
+    """
+
+    def __init__(self, loader: DataLoader, device: int):
+        self.loader = iter(loader)
+        self.device = device
+        self.stream = torch.cuda.Stream(device)
+        self.preload()
+
+    def preload(self):
+        try:
+            self.next_source, self.next_targets = next(self.loader)
+        except StopIteration:
+            self.next_source = self.next_targets = None
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_source = self.next_source.to(self.device, non_blocking=True)
+            self.next_targets = self.next_targets.to(self.device, non_blocking=True)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        torch.cuda.current_stream().wait_stream(self.stream)
+        source, targets = self.next_source, self.next_targets
+        if source is None:
+            raise StopIteration
+        # the batch was allocated on the side stream but is consumed on this one
+        source.record_stream(torch.cuda.current_stream())
+        targets.record_stream(torch.cuda.current_stream())
+        self.preload()
+        return source, targets
+
+
 class Trainer:
     def __init__(
         self,
@@ -40,11 +80,19 @@ class Trainer:
     ):
         self.config = trainer_cfg
         self.local_rank = int(os.environ["LOCAL_RANK"])
-        self.world_size = int(os.environ["WORLD_SIZE"])
-        self.global_rank = int(os.environ["RANK"])
+        self.world_size = dist.get_world_size()
+        self.global_rank = dist.get_rank()
 
         self.model = model.to(self.local_rank)
-        self.model = DDP(self.model, device_ids=[self.local_rank])
+        # the graph is the same every iteration, so DDP can skip the unused-parameter
+        # search and reuse its buckets; gradients live directly in the bucket views
+        self.model = DDP(
+            self.model,
+            device_ids=[self.local_rank],
+            gradient_as_bucket_view=True,
+            static_graph=True,
+            bucket_cap_mb=50,
+        )
         self.optimizer = optimizer
 
         self.train_dataloader = self._prepare_dataloader(train_dataset)
@@ -54,50 +102,127 @@ class Trainer:
         self.save_every = self.config.save_every
         if self.config.snapshot_path is None:
             self.config.snapshot_path = "snapshot.pt"
-        if os.path.exists(self.config.snapshot_path):
+        # check through fsspec so remote (s3://, gs://, ...) snapshots are resumed too
+        fs, path = fsspec.core.url_to_fs(self.config.snapshot_path)
+        if fs.exists(path):
             self._load_snapshot()
 
+        # compile after the snapshot is restored so state_dict keys stay unprefixed
+        if self.config.use_compile:
+            self.model = torch.compile(
+                self.model, mode="reduce-overhead", fullgraph=False
+            )
+
         if self.config.use_amp:
             self.scaler = torch.amp.GradScaler()
 
-    def _prepare_dataloader(self, dataset: Dataset):
+        self._snapshot_staging = None
+        self._snapshot_thread = None
+        self._snapshot_error = None
+
+    def _prepare_dataloader(self, dataset: Optional[Dataset]):
+        if dataset is None:
+            return None
         return DataLoader(
             dataset,
             batch_size=self.config.batch_size,
             num_workers=self.config.data_loader_workers,
             shuffle=False,
             pin_memory=True,
-            sampler=DistributedSampler(dataset),
+            # every rank draws the same seeded permutation, so no broadcast is needed;
+            # dropping the tail keeps all ranks at the same full batch size
+            sampler=DistributedSampler(dataset, shuffle=True, drop_last=True),
         )
 
+    def _stage_to_cpu(self, obj, staging=None):
+        # copy tensors into pinned CPU buffers (reused across saves) without blocking
+        if isinstance(obj, torch.Tensor):
+            if staging is None:
+                staging = torch.empty_like(obj, device="cpu", pin_memory=True)
+            staging.copy_(obj, non_blocking=True)
+            return staging
+        if isinstance(obj, dict):
+            staging = staging or {}
+            return type(obj)(
+                (k, self._stage_to_cpu(v, staging.get(k))) for k, v in obj.items()
+            )
+        return obj
+
+    def _write_snapshot(self, snapshot, copied: torch.cuda.Event, epoch):
+        try:
+            copied.synchronize()
+            # write next to the snapshot and swap it in only once complete, so a crash
+            # mid-write keeps the previous snapshot intact
+            tmp_path = self.config.snapshot_path + ".tmp"
+            torch.save(snapshot, tmp_path)
+            os.replace(tmp_path, self.config.snapshot_path)
+            print(f"Snapshot saved at epoch {epoch}")
+        except Exception as e:
+            self._snapshot_error = e
+
+    def _wait_for_snapshot(self):
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join()
+            self._snapshot_thread = None
+        if self._snapshot_error is not None:
+            error, self._snapshot_error = self._snapshot_error, None
+            raise RuntimeError("Saving the snapshot failed") from error
+
     def _save_snapshot(self, epoch):
+        # the previous save still reads the staging buffers we are about to overwrite
+        self._wait_for_snapshot()
+
         # capture snapshot
         model = self.model
         raw_model = model.module if hasattr(model, "module") else model
+        self._snapshot_staging = self._stage_to_cpu(
+            {
+                "model_state": raw_model.state_dict(),
+                "optimizer_state": self.optimizer.state_dict(),
+            },
+            self._snapshot_staging,
+        )
+        copied = torch.cuda.Event()
+        copied.record()
         snapshot = Snapshot(
-            model_state=raw_model.state_dict(),
-            optimizer_state=self.optimizer.state_dict(),
+            model_state=self._snapshot_staging["model_state"],
+            optimizer_state=self._snapshot_staging["optimizer_state"],
             finished_epoch=epoch,
         )
-        # save snapshot
-        snapshot = asdict(snapshot)
-        torch.save(snapshot, self.config.snapshot_path)
-        print(f"Snapshot saved at epoch {epoch}")
+
+        # save snapshot in the background, training resumes right away
+        self._snapshot_thread = threading.Thread(
+            target=self._write_snapshot, args=(vars(snapshot), copied, epoch)
+        )
+        self._snapshot_thread.start()
 
     def _load_snapshot(self):
         try:
-            snapshot = fsspec.open(
-                self.config.snapshot_path
-            )  # fsspec 为各种后端存储系统提供统一的 Python 接口，可以用相同的语法打开本地、AWS S3 和 GCS 等各种云存储平台的文件
-            with snapshot as f:
-                snapshot_data = torch.load(f, map_location="cpu")
+            if os.path.isfile(self.config.snapshot_path):
+                # memory-map local snapshots instead of reading them into memory first
+                snapshot_data = torch.load(
+                    self.config.snapshot_path,
+                    map_location="cpu",
+                    weights_only=True,
+                    mmap=True,
+                )
+            else:
+                snapshot = fsspec.open(
+                    self.config.snapshot_path, mode="rb", block_size=16 * 1024 * 1024
+                )  # fsspec 为各种后端存储系统提供统一的 Python 接口，可以用相同的语法打开本地、AWS S3 和 GCS 等各种云存储平台的文件
+                with snapshot as f:
+                    snapshot_data = torch.load(f, map_location="cpu", weights_only=True)
         except FileNotFoundError:
             print("Snapshot not found. Training model from scratch")
             return
 
         snapshot = Snapshot(**snapshot_data)
-        self.model.load_state_dict(snapshot.model_state)
-        self.optimizer.load_state_dict(snapshot.optimizer_state)
+        # snapshots hold the unwrapped model state, without the DDP `module.` prefix
+        raw_model = self.model.module if hasattr(self.model, "module") else self.model
+        raw_model.load_state_dict(snapshot.model_state)
+        # the optimizer state is only needed if there is training left to resume
+        if snapshot.finished_epoch < self.config.max_epochs:
+            self.optimizer.load_state_dict(snapshot.optimizer_state)
         self.epochs_run = snapshot.finished_epoch
         print(f"Resuming training from snapshot at Epoch {self.epochs_run}")
 
@@ -112,14 +237,14 @@ class Trainer:
             if self.config.use_amp:
                 self.scaler.scale(loss).backward()
                 torch.nn.utils.clip_grad_norm_(
-                    self.model.parameters(), self.config.grad_norm_clip
+                    self.model.parameters(), self.config.grad_norm_clip, foreach=True
                 )
                 self.scaler.step(self.optimizer)
                 self.scaler.update()
             else:
                 loss.backward()
                 torch.nn.utils.clip_grad_norm_(
-                    self.model.parameters(), self.config.grad_norm_clip
+                    self.model.parameters(), self.config.grad_norm_clip, foreach=True
                 )
                 self.optimizer.step()
         return loss
@@ -127,31 +252,37 @@ class Trainer:
     def _run_epoch(self, epoch: int, dataloader: DataLoader, train: bool = True):
         # set the epoch for the dataloader
         dataloader.sampler.set_epoch(epoch)
-        for iter, (source, targets) in enumerate(dataloader):
+        prefetcher = CudaPrefetcher(dataloader, self.local_rank)
+        # the buffer holds every loss between two prints, so both share one interval
+        log_every = 100
+        train_losses = torch.zeros(log_every, device=self.local_rank)
+        num_train_losses = 0
+        eval_loss = torch.zeros((), device=self.local_rank)
+        eval_steps = 0
+        for iter, (source, targets) in enumerate(prefetcher):
             step_type = "Train" if train else "Eval"
-            source = source.to(self.local_rank)
-            targets = targets.to(self.local_rank)
             batch_loss = self._run_batch(source, targets, train)
-            if iter % 100 == 0:
-                if train:
+            if train:
+                # keep the losses on the GPU and only sync when printing the mean of
+                # the losses since the previous print
+                train_losses[num_train_losses] = batch_loss.detach()
+                num_train_losses += 1
+                if iter % log_every == 0:
                     print(
-                        f"[GPU{self.global_rank}] Epoch {epoch} | Iter {iter} | {step_type} Loss {batch_loss.item():.5f}"
-                    )
-                else:
-                    eval_loss_list = [
-                        torch.zeros_like(batch_loss)
-                        for _ in range(dist.get_world_size())
-                    ]
-                    dist.gather(
-                        tensor=batch_loss,
-                        gather_list=eval_loss_list if self.local_rank == 0 else None,
-                        dst=0,
+                        f"[GPU{self.global_rank}] Epoch {epoch} | Iter {iter} | {step_type} Loss {train_losses[:num_train_losses].mean().item():.5f}"
                     )
-                    if self.local_rank == 0:
-                        for i, loss in enumerate(eval_loss_list):
-                            print(
-                                f"[GPU{i}] Epoch {epoch} | Iter {iter} | {step_type} Loss {loss.item():.5f}"
-                            )
+                    num_train_losses = 0
+            else:
+                eval_loss += batch_loss.detach()
+                eval_steps += 1
+
+        if not train and eval_steps > 0:
+            # losses are accumulated locally and reduced once per epoch, instead of
+            # gathering every rank's loss every 100 iterations
+            eval_loss /= eval_steps
+            dist.all_reduce(eval_loss, op=dist.ReduceOp.AVG)
+            if self.global_rank == 0:
+                print(f"Epoch {epoch} | Eval Loss {eval_loss.item():.5f}")
 
     def train(self):
         for epoch in range(self.epochs_run, self.config.max_epochs):
@@ -164,5 +295,7 @@ class Trainer:
                 self._save_snapshot(epoch)
 
             # eval run
-            if self.test_dataloader:
+            if self.test_dataloader is not None:
                 self._run_epoch(epoch, self.test_dataloader, train=False)
+
+        self._wait_for_snapshot()